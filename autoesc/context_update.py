@@ -7,9 +7,10 @@ content.
 
 from autoesc.context import *
 from autoesc import content, debug, escaping, html, js
-from functools32 import lru_cache
-from cStringIO import StringIO
+import collections
 import re
+import sre_constants
+import sre_parse
 
 def context_union(context0, context1):
     """
@@ -49,40 +50,138 @@ def context_union(context0, context1):
 # regex charset.
 NLS = u"\n\r\u2028\u2029"
 
-def _end_of_attr_value(raw_text, delim):
+# Matches a character that breaks a line in JavaScript source.
+_JS_LINE_TERMINATOR = re.compile(u'[%s]' % NLS)
+
+# Matches the end of an unquoted attribute value.
+_SPACE_OR_TAG_END = re.compile(r'[\s>]')
+
+# Matches characters that are suspicious in an unquoted attribute value.
+# http://www.w3.org/TR/html5/tokenization.html#attribute-value-unquoted-state
+_UNQUOTED_ATTR_DISALLOWED = re.compile(r'[\0"\'<=`]')
+
+# Maps DELIM_* to the quote that closes the attribute value in normalized
+# output.  Unquoted values are normalized to double quoted ones.
+_NORMALIZED_CLOSE_QUOTE = {
+    DELIM_DOUBLE_QUOTE: '"',
+    DELIM_SINGLE_QUOTE: "'",
+    DELIM_SPACE_OR_TAG_END: '"',
+    }
+
+def _end_of_attr_value(raw_text, start, delim):
     """
-    Returns the end of the attribute value of -1 if delim indicates we are
-    not in an attribute, or len(raw_text) if we are in an attribute but the
-    end does not appear in raw_text.
+    Returns the end of the attribute value that starts at start in raw_text
+    or -1 if delim indicates we are not in an attribute, or len(raw_text) if
+    we are in an attribute but the end does not appear in raw_text.
     """
     if delim == DELIM_NONE:
         return -1
-    if delim == DELIM_SPACE_OR_TAG_END:
-        match = re.search(r'[\s>]', raw_text)
-        if match:
-            return match.start(0)
+    quote = DELIM_TEXT[delim]
+    if quote:
+        end = raw_text.find(quote, start)
     else:
-        quote = raw_text.find(DELIM_TEXT[delim])
-        if quote >= 0:
-            return quote
-    return len(raw_text)
+        match = _SPACE_OR_TAG_END.search(raw_text, start)
+        end = match.start(0) if match else -1
+    if end < 0:
+        return len(raw_text)
+    return end
+
+
+# Matches the start of the source of a pattern that starts with \A,
+# possibly after inline flags like (?i) which are captured in group 1.
+_ANCHORED_PATTERN = re.compile(r'(\(\?[a-zA-Z]+\))?\\A')
 
 
+def _has_top_level_alternation(source):
+    """
+    True iff the regular expression source has a '|' outside any group or
+    character set, so that a leading \\A anchors only its first branch.
+    """
+    depth = 0
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        if ch == '\\':
+            i += 1
+        elif ch == '[':
+            # A ']' right after '[' or '[^' is part of the set.
+            i += 1
+            if source[i:i + 1] == '^':
+                i += 1
+            if source[i:i + 1] == ']':
+                i += 1
+            while i < n and source[i] != ']':
+                if source[i] == '\\':
+                    i += 1
+                i += 1
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and not depth:
+            return True
+        i += 1
+    return False
+
+
+# Ways in which a transition's next context can be derived, so that the token
+# loop can handle the common ones inline instead of calling
+# compute_next_context.
+# The next context is the prior context.
+_NEXT_CONTEXT_IS_PRIOR = 0
+# The next context is a constant that does not depend on the prior context.
+_NEXT_CONTEXT_IS_FIXED = 1
+# The next context is computed by compute_next_context.
+_NEXT_CONTEXT_IS_COMPUTED = 2
+
+
+# The transitions below run once per token, so they mask out the bits of a
+# context directly instead of calling accessors like element_type_of.
+# A keep_mask attribute holds the bits of the prior context that carry over
+# into the next context.
 class _Transition(object):
     """
     Encapsulates a grammar production and the context after that
     production is seen in a chunk of HTML/CSS/JS input.
     """
+
+    # False for transitions that override is_applicable_to.
+    # The token loop skips calling is_applicable_to when this is True.
+    always_applicable = True
+
+    # True for transitions that override raw_text_parts.
+    # The token loop copies the text of other tokens as is.
+    normalizes = False
+
     def __init__(self, pattern):
         if type(pattern) is type(re.compile('')):
             self.pattern = pattern
         else:
             self.pattern = re.compile(pattern)
+        # Tokens are matched at a start position in the whole text, but
+        # \A only matches at index 0 regardless of the start position.
+        # A pattern anchored with \A can only match where the token
+        # starts, so drop the \A and match there instead of searching.
+        source = self.pattern.pattern
+        anchor = _ANCHORED_PATTERN.match(source)
+        if anchor and _has_top_level_alternation(source[anchor.end():]):
+            # Dropping the \\A would anchor the other branches too.
+            raise ValueError(
+                '\\A anchors only the first branch of %r' % source)
+        self.anchored = bool(anchor)
+        if self.anchored:
+            self.token_pattern = re.compile(
+                (anchor.group(1) or '') + source[anchor.end():],
+                self.pattern.flags)
+            self.search = self.token_pattern.match
+        else:
+            self.token_pattern = self.pattern
+            self.search = self.pattern.search
 
     def is_applicable_to(self, prior, match):
         """
         True iff this transition can produce a context after the text in
-        raw_text[0:match.start(0) + match.end(0)].
+        match.string[match.pos:match.end(0)].
         This should not destructively modify the match.
 
         prior - The context prior to the token in match.
@@ -94,7 +193,7 @@ class _Transition(object):
     def compute_next_context(self, prior, match):
         """
         Computes the context that this production transitions to after
-        raw_text[0:match.start(0) + match.end(0)].
+        match.string[match.pos:match.end(0)].
 
         prior - The context prior to the token in match.
         match - The token matched by self.pattern.
@@ -103,12 +202,24 @@ class _Transition(object):
         """
         raise NotImplementedError('abstract')  # pragma: no cover
 
-    def raw_text(self, match):
+    def next_context_rule(self):
+        """
+        Returns (one of the _NEXT_CONTEXT_* kinds, its parameter) describing
+        how to derive the context after a token.  The parameter is the
+        constant context for _NEXT_CONTEXT_IS_FIXED, and the
+        compute_next_context method for _NEXT_CONTEXT_IS_COMPUTED.
+        """
+        return _NEXT_CONTEXT_IS_COMPUTED, self.compute_next_context
+
+    def raw_text_parts(self, match):
         """
         Called to normalize the matched text.
+        Returns a tuple of strings whose concatenation replaces
+        match.string[match.pos:match.end(0)], so that callers can append the
+        pieces to their output without building an intermediate string.
         """
         assert self
-        return match.string[:match.end()]
+        return (match.string[match.pos:match.end()],)
 
 
 class _ToTransition(_Transition):
@@ -124,43 +235,47 @@ class _ToTransition(_Transition):
     def compute_next_context(self, prior, match):
         return self.dest
 
+    def next_context_rule(self):
+        return _NEXT_CONTEXT_IS_FIXED, self.dest
+
 
-class _ToTagTransition(_Transition):
+class _ToTagTransition(_ToTransition):
     """
     A transition to a context in the body of an open tag for the given
     element.
     """
 
-    def __init__(self, regex, context):
-        _Transition.__init__(self, regex)
-        self.context = context
-
-    def compute_next_context(self, prior, match):
-        return self.context
-
 
 class _NormalizeTransition(_Transition):
     """
     A transition that replaces the matched text with alternate text.
     """
 
+    normalizes = True
+
     def __init__(self, transition, repl, replace_whole=False):
         _Transition.__init__(self, transition.pattern)
         self.transition = transition
         self.repl = repl
+        self.always_applicable = transition.always_applicable
         self.replace_whole = replace_whole
+        # The parts that replace the matched text.  Empty instead of ('',)
+        # so that elided text like comments adds nothing to the output.
+        self.repl_parts = (repl,) if repl else ()
 
-    def compute_next_context(self, prior, match):
-        return self.transition.compute_next_context(prior, match)
+    def next_context_rule(self):
+        return self.transition.next_context_rule()
 
     def is_applicable_to(self, prior, match):
         return self.transition.is_applicable_to(prior, match)
 
-    def raw_text(self, match):
+    def raw_text_parts(self, match):
         if self.replace_whole:
-            return self.repl
-        else:
-            return ''.join((match.string[:match.start()], self.repl))
+            return self.repl_parts
+        start = match.start()
+        if start == match.pos:
+            return self.repl_parts
+        return (match.string[match.pos:start],) + self.repl_parts
 
 
 class _NormalizeJsBlockCommentTransition(_NormalizeTransition):
@@ -191,12 +306,11 @@ class _NormalizeJsBlockCommentTransition(_NormalizeTransition):
     def __init__(self, pattern):
         _NormalizeTransition.__init__(self, pattern, "", True)
 
-    def raw_text(self, match):
-        text = match.string[:match.end()]
-        if re.search('[%s]' % NLS, text):
-            return '\n'
+    def raw_text_parts(self, match):
+        if _JS_LINE_TERMINATOR.search(match.string, match.pos, match.end()):
+            return ('\n',)
         else:
-            return ''
+            return ()
 
 _TAG_DONE_ELEMENT_TO_PARTIAL_CONTEXT = {
     ELEMENT_NONE: STATE_TEXT,
@@ -208,6 +322,13 @@ _TAG_DONE_ELEMENT_TO_PARTIAL_CONTEXT = {
     ELEMENT_XMP: STATE_RCDATA,
     }
 
+# Maps element types to the whole context after the end of a tag, the
+# partial context above combined with the element type.
+_TAG_DONE_ELEMENT_TO_CONTEXT = dict(
+    (el_type, partial_context | el_type)
+    for el_type, partial_context
+    in _TAG_DONE_ELEMENT_TO_PARTIAL_CONTEXT.iteritems())
+
 
 class _TagDoneTransition(_Transition):
     """
@@ -219,8 +340,7 @@ class _TagDoneTransition(_Transition):
         _Transition.__init__(self, regex)
 
     def compute_next_context(self, prior, match):
-        el_type = element_type_of(prior)
-        return _TAG_DONE_ELEMENT_TO_PARTIAL_CONTEXT[el_type] | el_type
+        return _TAG_DONE_ELEMENT_TO_CONTEXT[prior & ELEMENT_ALL]
 
 
 class _TransitionBackToTag(_Transition):
@@ -232,7 +352,7 @@ class _TransitionBackToTag(_Transition):
         _Transition.__init__(self, regex)
 
     def compute_next_context(self, prior, match):
-        return STATE_TAG | element_type_of(prior)
+        return STATE_TAG | (prior & ELEMENT_ALL)
 
 
 class _TransitionToAttrName(_Transition):
@@ -245,14 +365,14 @@ class _TransitionToAttrName(_Transition):
 
     def compute_next_context(self, prior, match):
         content_kind = html.attr_type(match.group(1))
-        attr = attr_type_of(prior)
+        attr = prior & ATTR_ALL
         if content_kind == content.CONTENT_KIND_JS:
             attr = ATTR_SCRIPT
         elif content_kind == content.CONTENT_KIND_CSS:
             attr = ATTR_STYLE
         elif content_kind == content.CONTENT_KIND_URL:
             attr = ATTR_URL
-        return STATE_ATTR_NAME | element_type_of(prior) | attr
+        return STATE_ATTR_NAME | (prior & ELEMENT_ALL) | attr
 
 
 class _TransitionToAttrValue(_Transition):
@@ -265,7 +385,7 @@ class _TransitionToAttrValue(_Transition):
 
     def compute_next_context(self, prior, match):
         return after_attr_delimiter(
-            element_type_of(prior), attr_type_of(prior), self.delim)
+            prior & ELEMENT_ALL, prior & ATTR_ALL, self.delim)
 
 
 class _TransitionToState(_Transition):
@@ -277,9 +397,10 @@ class _TransitionToState(_Transition):
         """A transition to the given state."""
         _Transition.__init__(self, regex)
         self.state = state
+        self.keep_mask = ~(URL_PART_ALL | STATE_ALL)
 
     def compute_next_context(self, prior, match):
-        return (prior & ~(URL_PART_ALL | STATE_ALL)) | self.state
+        return (prior & self.keep_mask) | self.state
 
 
 class _TransitionToJsString(_Transition):
@@ -291,11 +412,10 @@ class _TransitionToJsString(_Transition):
         """A transition to the given state."""
         _Transition.__init__(self, regex)
         self.state = state
+        self.keep_mask = ELEMENT_ALL | ATTR_ALL | DELIM_ALL
 
     def compute_next_context(self, prior, match):
-        return (
-            (prior & (ELEMENT_ALL | ATTR_ALL | DELIM_ALL))
-            | self.state)
+        return (prior & self.keep_mask) | self.state
 
 
 class _SlashTransition(_Transition):
@@ -306,14 +426,18 @@ class _SlashTransition(_Transition):
 
     def __init__(self, regex):
         _Transition.__init__(self, regex)
+        self.keep_mask = ~(STATE_ALL | JS_CTX_ALL)
+        # The bits to add after a division operator or at the start of a
+        # RegExp literal.
+        self.after_div_op = STATE_JS | JS_CTX_REGEX
+        self.after_regex_start = STATE_JSREGEXP
 
     def compute_next_context(self, prior, match):
-        js_ctx = js_ctx_of(prior)
+        js_ctx = prior & JS_CTX_ALL
         if js_ctx == JS_CTX_DIV_OP:
-            return ((prior & ~(STATE_ALL | JS_CTX_ALL))
-                    | STATE_JS | JS_CTX_REGEX)
+            return (prior & self.keep_mask) | self.after_div_op
         elif js_ctx == JS_CTX_REGEX:
-            return (prior & ~(STATE_ALL | JS_CTX_ALL)) | STATE_JSREGEXP
+            return (prior & self.keep_mask) | self.after_regex_start
         else:
             raise ContextUpdateFailure(
                 ("ambiguous / could start a division or a RegExp."
@@ -341,6 +465,9 @@ class _TransitionToSelf(_Transition):
     def compute_next_context(self, prior, match):
         return prior
 
+    def next_context_rule(self):
+        return _NEXT_CONTEXT_IS_PRIOR, None
+
 
 # Consumes the entire content without change if nothing else matched.
 _TRANSITION_TO_SELF = _TransitionToSelf(r'\Z')
@@ -355,11 +482,12 @@ class _URLPartTransition(_Transition):
 
     def __init__(self, pattern):
         _Transition.__init__(self, pattern)
+        self.keep_mask = ~URL_PART_ALL
 
     def compute_next_context(self, prior, match):
-        url_part = url_part_of(prior)
+        url_part = prior & URL_PART_ALL
         if url_part == URL_PART_NONE:
-            text = match.string[:match.end()].strip()
+            text = match.string[match.pos:match.end()].strip()
             if text:
                 # There is a non-space character preceding.
                 url_part = URL_PART_PRE_QUERY
@@ -368,7 +496,7 @@ class _URLPartTransition(_Transition):
             # Matches '?', '#', or an encoded form thereof.
             and match.group(1)):
             url_part = URL_PART_QUERY_OR_FRAG
-        return (prior & ~URL_PART_ALL) | url_part
+        return (prior & self.keep_mask) | url_part
 
 
 _URL_PART_TRANSITION = _URLPartTransition(r'([?#])|\Z')
@@ -376,27 +504,37 @@ _CSSURL_PART_TRANSITION = _URLPartTransition(
     r'([?#]|\\(?:23|3[fF]|[?#]))|\Z')
 
 
-class _EndTagTransition(_Transition):
+class _EndTagTransition(_ToTransition):
     """
     Transition when we see the start of an end tag like '</foo'.
     """
 
+    always_applicable = False
+
     def __init__(self, pattern):
         '''Matches the end of a special tag like "script".'''
-        _Transition.__init__(self, pattern)
-
-    # TODO: This transitions to an HTML_TAG state which accepts attributes.
-    # So we allow nonsensical constructs like </br foo="bar">.
-    # Add another HTML_END_TAG state that just accepts space and >.
-    def compute_next_context(self, prior, match):
-        return STATE_TAG | ELEMENT_NONE
+        # TODO: This transitions to an HTML_TAG state which accepts attributes.
+        # So we allow nonsensical constructs like </br foo="bar">.
+        # Add another HTML_END_TAG state that just accepts space and >.
+        _ToTransition.__init__(self, pattern, STATE_TAG | ELEMENT_NONE)
 
     def is_applicable_to(self, prior, match):
-        return attr_type_of(prior) == ATTR_NONE
+        return prior & ATTR_ALL == ATTR_NONE
 
 
-_SCRIPT_TAG_END = _EndTagTransition(r'(?i)<\/script\b')
-_STYLE_TAG_END = _EndTagTransition(r'(?i)<\/style\b')
+def _case_insensitive(letters):
+    """
+    A regular expression that matches the given ASCII letters in any case
+    without using re.IGNORECASE.
+    Patterns using the flag cannot share a fused alternation with patterns
+    that are case-sensitive since the flag applies to the whole alternation.
+    """
+    return ''.join('[%s%s]' % (ch.upper(), ch.lower()) for ch in letters)
+
+
+# These end tags appear among the transitions for every JS and CSS state.
+_SCRIPT_TAG_END = _EndTagTransition(r'<\/%s\b' % _case_insensitive('script'))
+_STYLE_TAG_END = _EndTagTransition(r'<\/%s\b' % _case_insensitive('style'))
 
 _ELEMENT_TO_TAG_NAME = {
     ELEMENT_TEXTAREA: "textarea",
@@ -406,22 +544,30 @@ _ELEMENT_TO_TAG_NAME = {
     }
 
 
-class _RcdataEndTagTransition(_Transition):
+class _RcdataEndTagTransition(_ToTransition):
     """
     Transition that handles exit from tags like <title> and <textarea>
     which cannot contain tags.
     """
 
-    def __init__(self, regex):
-        _Transition.__init__(self, regex)
+    always_applicable = False
 
-    def compute_next_context(self, prior, match):
-        return STATE_TAG | ELEMENT_NONE
+    def __init__(self, regex):
+        _ToTransition.__init__(self, regex, STATE_TAG | ELEMENT_NONE)
 
     def is_applicable_to(self, prior, match):
         return (
             match.group(1).lower()
-            == _ELEMENT_TO_TAG_NAME.get(element_type_of(prior)))
+            == _ELEMENT_TO_TAG_NAME.get(prior & ELEMENT_ALL))
+
+
+# Maps the quote, if any, that starts a CSS URL to the state and URL part
+# inside it.
+_CSS_URL_DELIM_TO_STATE = {
+    '"': STATE_CSSDQ_URL | URL_PART_NONE,
+    "'": STATE_CSSSQ_URL | URL_PART_NONE,
+    }
+_CSS_URL_UNQUOTED_STATE = STATE_CSS_URL | URL_PART_NONE
 
 
 class _CssUriTransition(_Transition):
@@ -435,16 +581,11 @@ class _CssUriTransition(_Transition):
         in group 1.
         """
         _Transition.__init__(self, regex)
+        self.keep_mask = ~(STATE_ALL | URL_PART_ALL)
 
     def compute_next_context(self, prior, match):
-        delim = match.group(1)
-        if "\"" == delim:
-            state = STATE_CSSDQ_URL
-        elif "'" == delim:
-            state = STATE_CSSSQ_URL
-        else:
-            state = STATE_CSS_URL
-        return (prior & ~(STATE_ALL | URL_PART_ALL)) | state | URL_PART_NONE
+        return (prior & self.keep_mask) | _CSS_URL_DELIM_TO_STATE.get(
+            match.group(1), _CSS_URL_UNQUOTED_STATE)
 
 
 class _DivPreceder(_Transition):
@@ -454,10 +595,11 @@ class _DivPreceder(_Transition):
 
     def __init__(self, regex):
         _Transition.__init__(self, regex)
+        self.keep_mask = ~(STATE_ALL | JS_CTX_ALL)
+        self.after = STATE_JS | JS_CTX_DIV_OP
 
     def compute_next_context(self, prior, match):
-        return ((prior & ~(STATE_ALL | JS_CTX_ALL))
-                | STATE_JS | JS_CTX_DIV_OP)
+        return (prior & self.keep_mask) | self.after
 
 
 # For each state, a group of token definitions and transitions to other states.
@@ -644,7 +786,8 @@ _TRANSITIONS[STATE_JSDQ_STR] = (
     _TransitionToSelf(
         r"(?i)" +                      # Case-insensitively
         r"\A(?:" +                     # from the start
-            r"[^\"\\" + NLS + r"<]" +  # match all but nls, quotes, \s, <;
+            r"[^\"\\" + NLS + r"<]+" + # match runs of all but nls, quotes,
+                                       # \s, <;
             r"|\\(?:" +                # or backslash followed by a
                 r"\r\n?" +             # line continuation
                 r"|[^\r<]" +           # or an escape
@@ -659,7 +802,8 @@ _TRANSITIONS[STATE_JSSQ_STR] = (
     _TransitionToSelf(
         r"(?i)" +
         r"\A(?:" +                     # Case-insensitively, from start
-            r"[^\'\\" + NLS + "<]" +   # match all but nls, quotes, \s, <;
+            r"[^\'\\" + NLS + "<]+" +  # match runs of all but nls, quotes,
+                                       # \s, <;
             r"|\\(?:" +                # or a backslash followed by a
                 r"\r\n?" +             # line continuation
                 r"|[^\r<]" +           # or an escape;
@@ -675,7 +819,8 @@ _TRANSITIONS[STATE_JSREGEXP] = (
         r"\A(?:" +
             # We have to handle [...] style character sets specially since
             # in /[/]/, the second solidus doesn't end the RegExp.
-            r"[^\[\\/<" + NLS + "]" +        # A non-charset, non-escape token;
+            r"[^\[\\/<" + NLS + "]+" +       # A run of non-charset, non-escape
+                                             # chars;
             r"|\\[^" + NLS + "]" +           # an escape;
             r"|\\?<(?!/script)" +
             r"|\[" +                         # or a character set containing
@@ -693,56 +838,331 @@ _TRANSITIONS[STATE_URL] = (_URL_PART_TRANSITION,)
 
 _TRANSITIONS = tuple(_TRANSITIONS)
 
+# For each state, the transitions in _TRANSITIONS as flat tuples:
+#   (search, is_applicable_to, next context kind, its parameter,
+#    raw_text_parts)
+# where the methods are pre-bound, is_applicable_to is None for transitions
+# that are always applicable, raw_text_parts is None for transitions that
+# do not normalize their text, and the next context kind and parameter
+# come from next_context_rule, so that the token loop does not repeatedly
+# look up attributes or call through wrapping transitions.
+_TRANSITION_TABLE = tuple(
+    transitions and tuple(
+        (transition.search,
+         None if transition.always_applicable
+         else transition.is_applicable_to)
+        + transition.next_context_rule()
+        + (transition.raw_text_parts if transition.normalizes else None,)
+        for transition in transitions)
+    for transitions in _TRANSITIONS)
+
+
+def _is_case_neutral(parsed):
+    """
+    True iff adding re.IGNORECASE to the parsed pattern cannot change what it
+    matches.  Without the LOCALE or UNICODE flags, IGNORECASE only folds
+    ASCII letters, so this checks that any ASCII letter the pattern mentions
+    is accompanied by its other case.
 
-def _process_next_token(text, context):
+    parsed - A sequence of (opcode, argument) pairs from sre_parse.
     """
-    Consume a portion of text and compute the next context.
-    Output is stored in member variables.
-    text - Non empty.
+    for opcode, arg in parsed:
+        if opcode in (sre_constants.LITERAL, sre_constants.NOT_LITERAL):
+            if arg < 0x80 and chr(arg).isalpha():
+                return False
+        elif opcode == sre_constants.IN:
+            letters = set()
+            for item_opcode, item_arg in arg:
+                if item_opcode == sre_constants.LITERAL:
+                    codes = (item_arg,)
+                elif item_opcode == sre_constants.RANGE:
+                    codes = xrange(item_arg[0], min(item_arg[1] + 1, 0x80))
+                else:
+                    continue
+                letters.update(
+                    chr(code) for code in codes
+                    if code < 0x80 and chr(code).isalpha())
+            if any(letter.swapcase() not in letters for letter in letters):
+                return False
+        elif opcode in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if not _is_case_neutral(arg[2]):
+                return False
+        elif opcode in (sre_constants.SUBPATTERN, sre_constants.ASSERT,
+                        sre_constants.ASSERT_NOT):
+            if not _is_case_neutral(arg[1]):
+                return False
+        elif opcode == sre_constants.BRANCH:
+            if not all(_is_case_neutral(branch) for branch in arg[1]):
+                return False
+    return True
+
+
+def _alternation(transitions, entries, flags):
+    """
+    Combines the token patterns of transitions into a single alternation.
+
+    Returns (the compiled alternation, a tuple indexed by the group wrapping
+    each branch of (its entry, whether the transition needs its own match)).
 
-    Returns (n, context after text[:n], replacement for text[:n])
+    A match of the alternation can stand in for a match of a branch's own
+    pattern when the branch has no groups of its own since transitions then
+    only use the span and text of the match.
+    """
+    branches = []
+    group_to_entry = [None]
+    for transition, entry in zip(transitions, entries):
+        pattern = transition.token_pattern
+        branches.append('(%s)' % pattern.pattern)
+        group_to_entry.append((entry, bool(pattern.groups)))
+        # lastindex never names a group nested inside a branch.
+        group_to_entry.extend([None] * pattern.groups)
+    return re.compile('|'.join(branches), flags), tuple(group_to_entry)
+
+
+def _fuse_transitions(transitions, entries):
+    """
+    Combines the patterns of a group of transitions into alternations so that
+    one or two regex calls find the earliest token instead of one search per
+    transition.
+    An alternation tries its branches in order at each position, so the
+    leftmost match comes from the first transition in declaration order that
+    matches there which is the same tie-break used by _scan_transitions.
+
+    transitions - The transitions for a state.
+    entries - The corresponding entries from _TRANSITION_TABLE.
+
+    Returns None if the transitions cannot share a pattern because the flags
+    of one would change what another matches, or
+    (the match method of an alternation of all the transitions, its group
+     table as described in _alternation, the search method of an
+     alternation of the transitions not anchored with \\A or None if there
+     are none, its group table).
+    Anchored transitions can only match where the token starts, so matching
+    the first alternation there and searching with the second otherwise
+    finds the same earliest token as searching with each transition.
+    """
+    flags = 0
+    for transition in transitions:
+        flags |= transition.pattern.flags
+    for transition in transitions:
+        pattern = transition.token_pattern
+        # Only re.IGNORECASE can be shared, and only with patterns that
+        # match the same text either way.
+        missing_flags = flags & ~pattern.flags
+        if missing_flags and (
+            missing_flags != re.IGNORECASE
+            or not _is_case_neutral(
+                sre_parse.parse(pattern.pattern, pattern.flags))):
+            return None
+    match_all, all_groups = _alternation(transitions, entries, flags)
+    unanchored = [
+        (transition, entry) for transition, entry in zip(transitions, entries)
+        if not transition.anchored]
+    if not unanchored:
+        return match_all.match, all_groups, None, None
+    search_unanchored, unanchored_groups = _alternation(
+        [transition for transition, _ in unanchored],
+        [entry for _, entry in unanchored], flags)
+    return (match_all.match, all_groups,
+            search_unanchored.search, unanchored_groups)
+
+# A flat table indexed by state of the result of _fuse_transitions for each
+# group of transitions in _TRANSITIONS.
+_FUSED_TRANSITIONS = tuple(
+    transitions and _fuse_transitions(transitions, entries)
+    for transitions, entries in zip(_TRANSITIONS, _TRANSITION_TABLE))
+
+
+def _scan_order(transitions, entries):
     """
+    Splits a group of transitions by whether they are anchored with \\A.
 
-    if is_error_context(context):  # The ERROR state is infectious.
-        return (len(text), context, text)
+    Returns (a tuple of (index, entry) for the anchored transitions,
+             a tuple of (index, entry, match method of the pattern) for the
+             others)
+    where index is the position of the transition in the group.
+    """
+    anchored = []
+    unanchored = []
+    for index, (transition, entry) in enumerate(zip(transitions, entries)):
+        if transition.anchored:
+            anchored.append((index, entry))
+        else:
+            unanchored.append((index, entry, transition.pattern.match))
+    return tuple(anchored), tuple(unanchored)
+
+# A flat table indexed by state of the result of _scan_order for each
+# group of transitions in _TRANSITIONS.
+_SCAN_ORDERS = tuple(
+    transitions and _scan_order(transitions, entries)
+    for transitions, entries in zip(_TRANSITIONS, _TRANSITION_TABLE))
+
+
+def _scan_transitions(text, pos, context):
+    """
+    Tries each transition for the state of context in turn and returns the
+    _TRANSITION_TABLE entry for the applicable one whose pattern matches
+    earliest in text at or after pos and its match, or (None, None) if none
+    match.
+    """
+    anchored, unanchored = _SCAN_ORDERS[state_of(context)]
+
+    # Anchored transitions can only match at pos, so try them first.
+    # If one applies there then only an unanchored transition declared
+    # before it can win, and only by matching at pos too, so there is no
+    # need to search the rest of text.
+    for index, entry in anchored:
+        match = entry[0](text, pos)
+        if match and (entry[1] is None or entry[1](context, match)):
+            for prior_index, prior_entry, match_at in unanchored:
+                if prior_index > index:
+                    break
+                prior_match = match_at(text, pos)
+                if prior_match and (
+                        prior_entry[1] is None
+                        or prior_entry[1](context, prior_match)):
+                    return prior_entry, prior_match
+            return entry, match
 
-    # Find the transition whose pattern matches earliest
-    # in the raw text.
     earliest_start = len(text)+1
-    earliest_transition = None
+    earliest_entry = None
     earliest_match = None
 
-    for transition in _TRANSITIONS[state_of(context)]:
-        match = transition.pattern.search(text)
+    for _, entry, _ in unanchored:
+        match = entry[0](text, pos)
         if not match:
             continue
         start = match.start(0)
-        if (start < earliest_start
-            and transition.is_applicable_to(context, match)):
+        if start < earliest_start and (
+                entry[1] is None or entry[1](context, match)):
             earliest_start = start
-            earliest_transition = transition
+            earliest_entry = entry
             earliest_match = match
+            if start == pos:
+                # Nothing can match earlier, and later transitions lose ties.
+                break
+
+    return earliest_entry, earliest_match
+
+
+# Tokens are looked up in a cache when the text they are drawn from is at
+# most this long.  Short texts like "<div class=\"" recur often in templates
+# while the hit rate for longer ones does not justify keeping them alive.
+_MAX_CACHED_TOKEN_TEXT = 256
+
+# Maps (text, type(text), pos, context) to the result of _next_token for
+# texts no longer than _MAX_CACHED_TOKEN_TEXT.
+# The result is a function of the key alone, and is immutable.
+_NEXT_TOKEN_CACHE = {}
+# The whole cache is cleared, rather than evicting single entries, once it
+# holds this many entries.
+_MAX_NEXT_TOKEN_CACHE = 4096
 
-    if earliest_transition:
-        num_consumed = earliest_match.end(0)
-        next_context = earliest_transition.compute_next_context(
-            context, earliest_match)
-        normalized_text = earliest_transition.raw_text(earliest_match)
+
+def _process_next_token(text, pos, context):
+    """
+    Consume a portion of text and compute the next context.
+    Output is stored in member variables.
+    text - The text containing the token.
+    pos - The start of the token.  Less than len(text).
+
+    Returns (end, context after text[pos:end], a tuple of strings whose
+    concatenation replaces text[pos:end] or None if text[pos:end] is
+    unchanged)
+    """
+    if len(text) > _MAX_CACHED_TOKEN_TEXT:
+        return _next_token(text, pos, context)
+    # The type is part of the key since equal str and unicode texts hash
+    # alike but the type of the normalized text must not change.
+    key = (text, type(text), pos, context)
+    result = _NEXT_TOKEN_CACHE.get(key)
+    if result is None:
+        result = _next_token(text, pos, context)
+        if len(_NEXT_TOKEN_CACHE) >= _MAX_NEXT_TOKEN_CACHE:
+            _NEXT_TOKEN_CACHE.clear()
+        _NEXT_TOKEN_CACHE[key] = result
+    return result
+
+
+def _next_token(text, pos, context):
+    """Implements _process_next_token."""
+
+    state = context & STATE_ALL
+    if state == STATE_ERROR:  # The ERROR state is infectious.
+        return (len(text), context, None)
+
+    # Find the transition whose pattern matches earliest
+    # in the raw text.
+    earliest_entry = None
+    earliest_match = None
+
+    fused = _FUSED_TRANSITIONS[state]
+    if fused is None:
+        earliest_entry, earliest_match = _scan_transitions(text, pos, context)
     else:
-        num_consumed = len(text)
+        match_all, all_groups, search_unanchored, unanchored_groups = fused
+        fused_match = match_all(text, pos)
+        group_to_entry = all_groups
+        if not fused_match and search_unanchored:
+            fused_match = search_unanchored(text, pos)
+            group_to_entry = unanchored_groups
+        if fused_match:
+            entry, rematch = group_to_entry[fused_match.lastindex]
+            search, is_applicable_to = entry[:2]
+            if rematch:
+                # Rerun the winning pattern by itself so that the match has
+                # the group numbering that the transition expects.
+                match = search(text, pos)
+            else:
+                match = fused_match
+            if is_applicable_to is None or is_applicable_to(context, match):
+                earliest_entry = entry
+                earliest_match = match
+            else:
+                # The winner is not applicable, but a transition matching at
+                # the same place or later might be.
+                earliest_entry, earliest_match = _scan_transitions(
+                    text, pos, context)
+
+    if earliest_entry:
+        _, _, next_context_kind, next_context_param, raw_text_parts = (
+            earliest_entry)
+        end = earliest_match.end(0)
+        if next_context_kind == _NEXT_CONTEXT_IS_PRIOR:
+            next_context = context
+        elif next_context_kind == _NEXT_CONTEXT_IS_FIXED:
+            next_context = next_context_param
+        else:
+            next_context = next_context_param(context, earliest_match)
+        if raw_text_parts is None:
+            normalized_parts = None
+        else:
+            normalized_parts = raw_text_parts(earliest_match)
+    else:
+        end = len(text)
         next_context = STATE_ERROR
-        normalized_text = text
+        normalized_parts = None
 
-    if (not num_consumed
-        and state_of(next_context) == state_of(context)):  # pragma: no cover
+    if (end == pos
+        and next_context & STATE_ALL == state):  # pragma: no cover
         # Infinite loop.
         raise Exception('inf loop. for %r in %s'
-                        % (text, debug.context_to_string(context)))
+                        % (text[pos:], debug.context_to_string(context)))
+
+    return (end, next_context, normalized_parts)
 
-    return (num_consumed, next_context, normalized_text)
+
+# Maps (raw_text, type(raw_text), context) to the result of
+# process_raw_text for chunks that processed without error.
+# Templates repeat many raw text chunks like '<div class="' verbatim.
+_PROCESSED_RAW_TEXT = {}
+# The keys of _PROCESSED_RAW_TEXT oldest first.  Once the cache holds
+# _MAX_PROCESSED_RAW_TEXT entries, each new entry evicts the oldest so that
+# memory use stays bounded however varied the raw text.
+_PROCESSED_RAW_TEXT_KEYS = collections.deque()
+_MAX_PROCESSED_RAW_TEXT = 64
 
 
-[lru_cache]
 def process_raw_text(raw_text, context):
     """
     raw_text - A chunk of HTML/CSS/JS.
@@ -757,140 +1177,274 @@ def process_raw_text(raw_text, context):
     May raise ContextUpdateFailure which is equivalent to returning
     STATE_ERROR but with a more informative error message.
     """
+    # The type is part of the key since equal str and unicode values hash
+    # alike but normalize to different types.
+    key = (raw_text, type(raw_text), context)
+    result = _PROCESSED_RAW_TEXT.get(key)
+    if result is None:
+        result = _process_raw_text(raw_text, context)
+        if result[2] is None:  # Only cache results without errors.
+            if len(_PROCESSED_RAW_TEXT_KEYS) >= _MAX_PROCESSED_RAW_TEXT:
+                oldest_key = _PROCESSED_RAW_TEXT_KEYS.popleft()
+                _PROCESSED_RAW_TEXT.pop(oldest_key, None)
+            _PROCESSED_RAW_TEXT[key] = result
+            _PROCESSED_RAW_TEXT_KEYS.append(key)
+    return result
+
+
+def _process_raw_text(raw_text, context):
+    """Implements process_raw_text without caching."""
+
+    normalized = []
+    # The start of the unprocessed suffix of raw_text.  Tracking an index
+    # instead of slicing off processed text avoids copying the rest of
+    # raw_text for each token.
+    pos = 0
+    text_len = len(raw_text)
+
+    # The bits of the context are masked out inline instead of via
+    # accessors like state_of and is_error_context since this loop runs once
+    # per handler call, and a call may consume as little as one token.
+    while pos < text_len:
+        prior_context, prior_pos = context, pos
+
+        handler = _HANDLERS[context & _HANDLER_BITS]
+        pos, context = handler(raw_text, pos, context, normalized)
+
+        if context & STATE_ALL == STATE_ERROR:
+            return (context, None, prior_context, raw_text[prior_pos:])
+    # Join on an empty string of raw_text's type since the parts may all be
+    # str literals like '"' even when raw_text is unicode.
+    return (context, raw_text[:0].join(normalized), None, None)
+
+
+# The handlers below each process a prefix of raw_text[pos:] in a context
+# and return (the end of the processed prefix, the context after it) after
+# appending its normalized form to normalized.
+
+
+def _process_tokens(raw_text, pos, context, normalized):
+    """
+    Processes tokens outside attribute values up to and including the first
+    one that is normalized or that leads to a context for another handler.
+    A run of tokens that are not normalized is appended as a single slice.
+    """
+    # The loop below only updates plain locals so that it stays simple for
+    # tracing JITs like PyPy's as well as cheap under CPython.
+    run_start, run_context = pos, context
+    text_len = len(raw_text)
+    next_token = _process_next_token
+    run_states = _TOKEN_RUN_STATES
+    while True:
+        end, next_context, replacement_parts = next_token(
+            raw_text, pos, context)
+        if (replacement_parts is not None
+            or end == text_len
+            or next_context & DELIM_ALL != DELIM_NONE
+            or next_context & STATE_ALL not in run_states):
+            break
+        pos, context = end, next_context
+
+    if (next_context & STATE_ALL == STATE_ERROR
+        and (pos != run_start or context != run_context)):
+        # Stop before the token so that the caller reports the error as
+        # starting there instead of at the start of the run.
+        if pos != run_start:
+            normalized.append(raw_text[run_start:pos])
+        return pos, context
+
+    if replacement_parts is None:
+        normalized.append(raw_text[run_start:end])
+    else:
+        if pos != run_start:
+            normalized.append(raw_text[run_start:pos])
+        normalized.extend(replacement_parts)
 
-    normalized = StringIO()
-
-    while raw_text:
-        prior_context, prior_raw_text = context, raw_text
-
-        delim_type = delim_type_of(context)
-
-        # If we are in an attribute value, then decode raw_text (except
-        # for the delimiter) up to the next occurrence of delimiter.
+    if next_context & DELIM_ALL == DELIM_SPACE_OR_TAG_END:
+        # Introduce a double quote when we transition into an unquoted
+        # attribute body.
+        normalized.append('"')
+    return end, next_context
 
-        # The end of the section to decode.  Either before a delimiter
-        # or > symbol that closes an attribute, at the end of the raw_text,
-        # or -1 if no decoding needs to happen.
 
-        attr_value_end = _end_of_attr_value(raw_text, delim_type)
-        if attr_value_end == -1:
-            # Outside an attribute value.  No need to decode.
-            num_consumed, context, replacement_text = _process_next_token(
-                raw_text, context)
-            raw_text = raw_text[num_consumed:]
-            normalized.write(replacement_text)
+def _process_text(raw_text, pos, context, normalized):
+    """
+    Processes a run of plain text and the token after it in STATE_TEXT or
+    STATE_RCDATA.
+    Only '<' can start a token other than the run of text before it, so
+    skip straight to it instead of trying all the transitions for the state.
+    """
+    tag_start = raw_text.find('<', pos)
+    if tag_start < 0:
+        normalized.append(raw_text[pos:])
+        return len(raw_text), context
+    elif tag_start == pos:
+        return _process_tokens(raw_text, pos, context, normalized)
+    normalized.append(raw_text[pos:tag_start])
+    end, next_context = _process_tokens(
+        raw_text, tag_start, context, normalized)
+    if next_context & STATE_ALL == STATE_ERROR:
+        # Stop before the tag so that the caller reports the error as
+        # starting there instead of at the start of the run of text.
+        return tag_start, context
+    return end, next_context
+
+
+def _process_attr_value(raw_text, pos, context, normalized):
+    """
+    Processes the rest of an attribute value and its closing delimiter if
+    any, decoding the value before processing the tokens in it.
+    """
+    delim_type = delim_type_of(context)
+
+    # The end of the section to decode.  Either before a delimiter
+    # or > symbol that closes an attribute, or at the end of the raw_text.
+    attr_value_end = _end_of_attr_value(raw_text, pos, delim_type)
+
+    if delim_type == DELIM_SPACE_OR_TAG_END:
+        attr_value = raw_text[pos:attr_value_end]
+        # Check for suspicious characters in the value.
+        # http://www.w3.org/TR/html5/tokenization.html
+        # #attribute-value-unquoted-state
+        # identifies [\0"'<=`] as transitions to error states.
+        # If they occur in an unquoted value they are almost surely
+        # an indication of an error in the template.
+        bad = _UNQUOTED_ATTR_DISALLOWED.search(attr_value)
+        if bad:
+            raise ContextUpdateFailure(
+                '%r in unquoted attr: %r'
+                % (bad.group(), attr_value))
+
+    # All of the languages we deal with (HTML, CSS, and JS) use
+    # quotes as delimiters.
+    # When one language is embedded in the other, we need to
+    # decode delimiters before trying to parse the content in the
+    # embedded language.
+
+    # For example, in
+    #       <a onclick="alert(&quot;Hello {$world}&quot;)">
+    # the decoded value of the event handler is
+    #       alert("Hello {$world}")
+    # so to determine the appropriate escaping convention we decode
+    # the attribute value before delegating to _process_next_token.
+
+    # We could take the cross-product of two languages to avoid
+    # decoding but that leads to either an explosion in the
+    # number of states, or the amount of lookahead required.
+
+    # The end of the attribute value.  At attr_value_end, or
+    # attr_value_end + 1 if a delimiter needs to be consumed.
+    if attr_value_end < len(raw_text):
+        attr_end = attr_value_end + len(DELIM_TEXT[delim_type])
+    else:
+        attr_end = -1
+
+    # Decode so that the JavaScript rules work on attribute values
+    # like
+    #     <a onclick='alert(&quot;{$msg}!&quot;)'>
+
+    # If we've already processed the tokens "<a", " onclick='" to
+    # get into the single quoted JS attribute context, then we do
+    # three things:
+    #   (1) This class will decode "&quot;" to "\"" and work below
+    #       to go from STATE_JS to STATE_JSDQ_STR.
+    #   (2) Then the caller checks {$msg} and realizes that $msg is
+    #       part of a JS string.
+    #   (3) Then, the above will identify the "'" as the end, and
+    #       so we reach here with:
+    #       r a w T e x t = " ! & q u o t ; ) ' > "
+    #                         ^               ^ ^
+    #                       pos  attr_value_end attr_end
+
+    # We use this example more in the comments below.
+
+    # The decoded value is processed starting at tail_pos in
+    # attr_value_tail.  A value that runs to the end of raw_text
+    # with nothing to decode is processed in place instead of
+    # being copied out.
+    if (attr_value_end == len(raw_text)
+        and raw_text.find('&', pos) < 0):
+        attr_value_tail, tail_pos = raw_text, pos
+    else:
+        attr_value_tail = html.unescape_html(raw_text[pos:attr_value_end])
+        tail_pos = 0
+    # attr_value_tail is "!\")" in the example above.
 
-            if delim_type_of(context) == DELIM_SPACE_OR_TAG_END:
-                # Introduce a double quote when we transition into an unquoted
-                # attribute body.
-                normalized.write('"')
-        else:
-            # Inside an attribute value.  Find the end and decode up to it.
-
-            if delim_type == DELIM_SPACE_OR_TAG_END:
-                # Check for suspicious characters in the value.
-                # http://www.w3.org/TR/html5/tokenization.html
-                # #attribute-value-unquoted-state
-                # identifies [\0"'<=`] as transitions to error states.
-                # If they occur in an unquoted value they are almost surely
-                # an indication of an error in the template.
-                bad = re.search(r'[\x00"\'<=`]', raw_text[:attr_value_end])
-                if bad:
-                    raise ContextUpdateFailure(
-                        '%r in unquoted attr: %r'
-                        % (bad.group(), raw_text[:attr_value_end]))
-
-            # All of the languages we deal with (HTML, CSS, and JS) use
-            # quotes as delimiters.
-            # When one language is embedded in the other, we need to
-            # decode delimiters before trying to parse the content in the
-            # embedded language.
-
-            # For example, in
-            #       <a onclick="alert(&quot;Hello {$world}&quot;)">
-            # the decoded value of the event handler is
-            #       alert("Hello {$world}")
-            # so to determine the appropriate escaping convention we decode
-            # the attribute value before delegating to _process_next_token.
-
-            # We could take the cross-product of two languages to avoid
-            # decoding but that leads to either an explosion in the
-            # number of states, or the amount of lookahead required.
-
-            # The end of the attribute value.  At attr_value_end, or
-            # attr_value_end + 1 if a delimiter needs to be consumed.
-            if attr_value_end < len(raw_text):
-                attr_end = attr_value_end + len(DELIM_TEXT[delim_type])
-            else:
-                attr_end = -1
-
-            # Decode so that the JavaScript rules work on attribute values
-            # like
-            #     <a onclick='alert(&quot;{$msg}!&quot;)'>
-
-            # If we've already processed the tokens "<a", " onclick='" to
-            # get into the single quoted JS attribute context, then we do
-            # three things:
-            #   (1) This class will decode "&quot;" to "\"" and work below
-            #       to go from STATE_JS to STATE_JSDQ_STR.
-            #   (2) Then the caller checks {$msg} and realizes that $msg is
-            #       part of a JS string.
-            #   (3) Then, the above will identify the "'" as the end, and
-            #       so we reach here with:
-            #       r a w T e x t = " ! & q u o t ; ) ' > "
-            #                                         ^ ^
-            #                            attr_value_end attr_end
-
-            # We use this example more in the comments below.
-
-            attr_value_tail = html.unescape_html(raw_text[:attr_value_end])
-            # attr_value_tail is "!\")" in the example above.
-
-            if delim_type == DELIM_SINGLE_QUOTE:
-                escaper = escaping.escape_html_sq_only
-            else:
-                escaper = escaping.escape_html_dq_only
+    if delim_type == DELIM_SINGLE_QUOTE:
+        escaper = escaping.escape_html_sq_only
+    else:
+        escaper = escaping.escape_html_dq_only
+
+    # Recurse on the decoded value.
+    # Runs of tokens that are not normalized are escaped as one slice.
+    append = normalized.append
+    next_token = _process_next_token
+    tail_len = len(attr_value_tail)
+    run_start = tail_pos
+    while tail_pos < tail_len:
+        token_start = tail_pos
+        tail_pos, context, replacement_parts = next_token(
+            attr_value_tail, tail_pos, context)
+        if replacement_parts is not None:
+            if token_start != run_start:
+                append(escaper(attr_value_tail[run_start:token_start]))
+            for replacement in replacement_parts:
+                append(escaper(replacement))
+            run_start = tail_pos
+    if tail_pos != run_start:
+        append(escaper(attr_value_tail[run_start:tail_pos]))
+
+    # TODO: Maybe check that context is legal to end an attr in.
+    # Throw if the attribute ends inside a quoted string.
+
+    if attr_end != -1:
+        pos = attr_end
+        # raw_text[pos:] is now ">" from the example above.
+
+        # When an attribute ends, we're back in the tag.
+        context = STATE_TAG | (context & ELEMENT_ALL)
+
+        # Append the delimiter on exiting an attribute.
+        # Inserts an end quote for unquoted attributes.
+        append(_NORMALIZED_CLOSE_QUOTE[delim_type])
+    else:
+        # Whole tail is part of an unterminated attribute.
+        assert attr_value_end == len(raw_text)  # Illegal state.
+        pos = len(raw_text)
+    return pos, context
 
-            # Recurse on the decoded value.
-            while attr_value_tail:
-                num_consumed, context, replacement = _process_next_token(
-                    attr_value_tail, context)
-                attr_value_tail = attr_value_tail[num_consumed:]
-                normalized.write(escaper(replacement))
 
-            # TODO: Maybe check that context is legal to end an attr in.
-            # Throw if the attribute ends inside a quoted string.
+# For each state, the handler for text outside attribute values.
+_RAW_TEXT_HANDLERS = tuple(
+    _process_text if state in (STATE_TEXT, STATE_RCDATA) else _process_tokens
+    for state in xrange(0, COUNT_OF_STATES))
 
-            if attr_end != -1:
-                raw_text = raw_text[attr_end:]
-                # raw_text is now ">" from the example above.
+# The bits of a context that determine its handler.
+_HANDLER_BITS = STATE_ALL | DELIM_ALL
 
-                # When an attribute ends, we're back in the tag.
-                context = STATE_TAG | element_type_of(context)
+# For each value of the _HANDLER_BITS of a context, the handler for the text
+# after it, so that the token loop picks a handler with one index instead of
+# testing the delimiter and then the state.
+_HANDLERS = tuple(
+    (_RAW_TEXT_HANDLERS[bits & STATE_ALL]
+     if bits & STATE_ALL < COUNT_OF_STATES else None)
+    if bits & DELIM_ALL == DELIM_NONE else _process_attr_value
+    for bits in xrange(0, _HANDLER_BITS + 1))
 
-                # Append the delimiter on exiting an attribute.
-                if delim_type == DELIM_SINGLE_QUOTE:
-                    normalized.write("'")
-                else:
-                    # Inserts an end quote for unquoted attributes.
-                    normalized.write('"')
-            else:
-                # Whole tail is part of an unterminated attribute.
-                if attr_value_end != len(raw_text):  # pragma: no cover
-                    raise AssertionError()  # Illegal state.
-                raw_text = ""
-        if is_error_context(context):
-            return (context, None, prior_context, prior_raw_text)
-    return (context, normalized.getvalue(), None, None)
+# States in which _process_tokens keeps consuming a run of tokens.
+_TOKEN_RUN_STATES = frozenset(
+    state for state in xrange(0, COUNT_OF_STATES)
+    if (_RAW_TEXT_HANDLERS[state] is _process_tokens
+        and state != STATE_ERROR))
 
 
-class ContextUpdateFailure(BaseException):
+class ContextUpdateFailure(Exception):
     """
     Raised on failure to update context to carry an informative error message
     when STATE_ERROR doesn't cut it.
     """
     def __init__(self, msg):
-        BaseException.__init__(self, msg)
+        Exception.__init__(self, msg)
 
 
 # TODO: If we need to deal with untrusted templates, then we need to make
@@ -779,10 +779,16 @@ def _escape_html_helper(value):
 
 def escape_html_sq_only(value):
     """ Escapes an HTML attribute value for embedding between single quotes."""
+    # Most chunks need no escaping, and a search is cheaper than a sub.
+    if not _MATCHER_FOR_ESCAPE_HTML_SQ_ONLY.search(value):
+        return value
     return _MATCHER_FOR_ESCAPE_HTML_SQ_ONLY.sub(_replacer_for_html, value)
 
 def escape_html_dq_only(value):
     """ Escapes an HTML attribute value for embedding between double quotes."""
+    # Most chunks need no escaping, and a search is cheaper than a sub.
+    if not _MATCHER_FOR_ESCAPE_HTML_DQ_ONLY.search(value):
+        return value
     return _MATCHER_FOR_ESCAPE_HTML_DQ_ONLY.sub(_replacer_for_html, value)
 
 
@@ -137,8 +137,27 @@ _ATTR_VALUE_TYPES = {
     "xmlns":           content.CONTENT_KIND_URL,
     }
 
+# Maps attribute names, as written, to their content kinds.
+# Templates use the same few attribute names over and over.
+_ATTR_TYPE_CACHE = {}
+# The cache is emptied when it grows past this many entries.
+_MAX_ATTR_TYPE_CACHE = 1024
+
 def attr_type(attr_name):
     """The content kind of the attribute with the given name."""
+    try:
+        return _ATTR_TYPE_CACHE[attr_name]
+    except KeyError:
+        pass
+    typ = _attr_type(attr_name)
+    if len(_ATTR_TYPE_CACHE) >= _MAX_ATTR_TYPE_CACHE:
+        _ATTR_TYPE_CACHE.clear()
+    _ATTR_TYPE_CACHE[attr_name] = typ
+    return typ
+
+
+def _attr_type(attr_name):
+    """Implements attr_type without caching."""
 
     attr_name = attr_name.lower()
     colon = attr_name.find(':')
@@ -12,6 +12,15 @@ _REGEX_PRECEDER_KEYWORDS = set([
     "break", "case", "continue", "delete", "do", "else", "finally",
     "instanceof", "return", "throw", "try", "typeof"])
 
+# Punctuation that, as the last character of a run of tokens, means a
+# following slash starts a regular expression.
+_REGEX_PRECEDER_PUNC = frozenset('!#%&(*,:;<=>?[^{|}~')
+
+# The word at the end of a run of tokens.
+# The lookbehind fails fast at positions inside a word so that searching
+# does not rescan the rest of each word up to the end.
+_LAST_WORD = re.compile(r'(?<![\w$])[\w$]+\Z')
+
 def next_js_ctx(js_tokens, ctx):
     """
     True iff a slash after the given run of non-whitespace tokens
@@ -48,11 +57,8 @@ def next_js_ctx(js_tokens, ctx):
     last_char = js_tokens[-1]
     if last_char == '+' or last_char == '-':
         # ++ and -- are not
-        sign_start = js_tokens_len - 1
         # Count the number of adjacent dashes or pluses.
-        while sign_start > 0 and js_tokens[sign_start - 1] == last_char:
-            sign_start -= 1
-        num_adjacent = js_tokens_len - sign_start
+        num_adjacent = js_tokens_len - len(js_tokens.rstrip(last_char))
         # True for odd numbers since "---" is the same as "-- -".
         # False for even numbers since "----" is the same as "-- --" which ends
         # with a decrement, not a minus sign.
@@ -65,11 +71,11 @@ def next_js_ctx(js_tokens, ctx):
             is_regex = not ("0" <= after_dot <= "9")
     elif last_char == '/':  # Match a div op, but not a regexp.
         is_regex = js_tokens_len <= 2
-    elif re.search(r'[!#%&(*,:;<=>?\[^{|}~]', last_char):
+    elif last_char in _REGEX_PRECEDER_PUNC:
         is_regex = True
     else:
         # Look for one of the keywords above.
-        word = re.search(r'[\w$]+\Z', js_tokens)
+        word = _LAST_WORD.search(js_tokens)
         is_regex = (word and word.group(0)) in _REGEX_PRECEDER_KEYWORDS
     ctx = ctx & ~context.JS_CTX_ALL
     if is_regex:
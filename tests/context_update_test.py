@@ -28,6 +28,10 @@ class ContextUpdateTest(unittest.TestCase):
                 'Hello, World!',
                 0,
                 ),
+            (
+                u'Caf\u00e9\u2028na\u00efve',
+                0,
+                ),
             (
                 # An orphaned "<" is OK.
                 'I <3 Ponies!',
@@ -453,6 +457,10 @@ class ContextUpdateTest(unittest.TestCase):
                 '<script>foo</script>',
                 context.STATE_TEXT,
                 ),
+            (
+                '<script>x = /foo</script>',
+                context.STATE_TEXT,
+                ),
             (
                 '<script>foo</script><!--',
                 context.STATE_HTMLCMT,
@@ -583,6 +591,62 @@ class ContextUpdateTest(unittest.TestCase):
                 msg = ("input %r: want text\n\t%r\ngot\n\t%r"
                        % (test_input, want_text, got_text)))
 
+    def test_repeated_raw_text(self):
+        """
+        Processing the same chunk again gives the same result, and equal
+        str and unicode chunks each normalize to their own type.
+        """
+        tests = (
+            ('<b title=foo>', 0, context.STATE_TEXT, '<b title="foo">'),
+            # The normalized text is made only of literal parts.
+            ('"', context.STATE_ATTR | context.DELIM_DOUBLE_QUOTE,
+             context.STATE_TAG, '"'),
+            )
+        for test_input, start_ctx, want_ctx, want_text in tests:
+            for test_input in (test_input, unicode(test_input)):
+                for _ in xrange(0, 2):
+                    got_ctx, got_text, _, _ = (
+                        context_update.process_raw_text(
+                            test_input, start_ctx))
+                    self.assertEquals(want_ctx, got_ctx)
+                    self.assertEquals(want_text, got_text)
+                    self.assertEquals(type(test_input), type(got_text))
+
+    def test_elided_tokens_add_no_parts(self):
+        """
+        Tokens that are normalized away add no empty strings to the
+        normalized parts.
+        """
+        tests = (
+            ('<!--x-->', context.STATE_TEXT, []),
+            ('a<!--x-->b', context.STATE_TEXT, ['a', 'b']),
+            ('a//b\n', context.STATE_JS, ['a', '\n']),
+            ('a/*b*/c', context.STATE_JS, ['a', ' ', 'c']),
+            ('a//b\n', context.STATE_CSS, ['a', '\n']),
+            )
+        for test_input, start_ctx, want in tests:
+            normalized = []
+            pos = 0
+            ctx = start_ctx
+            while pos < len(test_input):
+                pos, ctx = context_update._HANDLERS[
+                    ctx & context_update._HANDLER_BITS](
+                        test_input, pos, ctx, normalized)
+            self.assertEquals(want, normalized, test_input)
+
+    def test_context_update_failure(self):
+        """
+        Failures with an informative message can be caught as ordinary
+        exceptions.
+        """
+        try:
+            context_update.process_raw_text('<a title=x"y>', 0)
+        except Exception, err:
+            self.assertTrue(
+                isinstance(err, context_update.ContextUpdateFailure))
+            self.assertEquals("'\"' in unquoted attr: 'x\"y'", str(err))
+        else:
+            self.fail('expected a ContextUpdateFailure')
 
     def test_redundant_funcs(self):
         """